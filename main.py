@@ -1,9 +1,21 @@
 import os
 import argparse
-import gzip
+import asyncio
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections.abc import Iterator
+from fnmatch import fnmatch
+from pathlib import PurePosixPath
+from urllib.parse import urlparse
+
+import aioftp
+import numba
+import numpy as np
 import pandas as pd
-from subprocess import run
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pacsv
+from isal import igzip
 
 """Constants"""
 
@@ -15,6 +27,44 @@ temp_download_folder = os.path.abspath(
     os.path.expanduser("~/temp-ftp-downloads/")
 )
 output_folder = os.path.abspath(os.path.expanduser("~/ensembl-ftp-etl-output/"))
+gtf_accept_pattern = "*.gtf.gz"  # download only compressed GTF files
+gtf_reject_patterns = ("*.chr*", "*abinitio*")  # skip per-chromosome files
+max_concurrent_downloads = 8  # parallel FTP connections to the server
+read_buffer_size = 128 * 1024  # bytes downloaded/decompressed at a time
+write_buffer_size = 256 * 1024  # buffer for writing decompressed files
+gtf_columns = [
+    "seqname",
+    "source",
+    "feature",
+    "start",
+    "end",
+    "score",
+    "strand",
+    "frame",
+    "attribute",
+]
+key_attributes = ["gene_id", "gene_biotype"]
+key_attribute_bytes = {  # attribute names as the Numba scanner expects them
+    key: np.frombuffer(key.encode(), dtype=np.uint8) for key in key_attributes
+}
+gtf_chunk_size = 64 * 1024 * 1024  # bytes of GTF text parsed per chunk
+max_transform_workers = min(4, os.cpu_count() or 1)  # GTF files in memory
+output_compresslevel = 1  # fastest gzip level for the output files
+output_columns = ["gene_id", "feature", "gene_biotype", "seqname", "source"]
+# Keep strings in Arrow memory so attribute scanning reads them in place
+gtf_pandas_types = {pa.string(): pd.ArrowDtype(pa.string())}
+gtf_used_columns = ["seqname", "source", "feature", "attribute"]
+gtf_column_types = {
+    "seqname": pa.string(),
+    "source": pa.dictionary(pa.int32(), pa.string()),  # read as categories
+    "feature": pa.dictionary(pa.int32(), pa.string()),
+    "start": pa.int32(),
+    "end": pa.int32(),
+    "score": pa.string(),
+    "strand": pa.dictionary(pa.int32(), pa.string()),
+    "frame": pa.string(),
+    "attribute": pa.string(),
+}
 
 """Functions"""
 
@@ -32,27 +82,82 @@ def download_gtf_files(release: str | int, species: str):
 
     """
 
-    wget_command = [
-        "wget",
-        "-r",  # recursive
-        "-l",
-        "1",  # limit recursion depth to 1
-        "-np",  # don't ascend to the parent directory
-        "-nd",  # don't recreate directory structure
-        "--directory-prefix",
-        temp_download_folder,
-        "-A",
-        "*.gtf.gz",  # accept only .gtf.gz files
-        "-R",
-        "*.chr*,*abinitio*",  # reject files containing matching patterns
-        f"{default_ensembl_ftp_url}{release}/gtf/{species}/",
-    ]
-    result = run(wget_command, capture_output=True, text=True)
+    url = urlparse(f"{default_ensembl_ftp_url}{release}/gtf/{species}/")
+    os.makedirs(temp_download_folder, exist_ok=True)
+    downloaded = asyncio.run(_download_all(url.hostname, url.path))
+    print(
+        f"Successfully downloaded {len(downloaded)} files "
+        f"to {temp_download_folder}"
+    )
 
-    if result.returncode == 0:
-        print(f"Successfully downloaded to {temp_download_folder}")
-    else:
-        print(f"Error occurred: {result.stderr}")
+
+def _is_wanted_gtf(filename: str) -> bool:
+    """
+    Check a remote filename against the accept and reject patterns
+
+    Args:
+        filename: Name of the file on the FTP server
+    Returns:
+        bool: True if the file should be downloaded
+    """
+
+    return fnmatch(filename, gtf_accept_pattern) and not any(
+        fnmatch(filename, pattern) for pattern in gtf_reject_patterns
+    )
+
+
+async def _download_all(host: str, remote_dir: str) -> list[str]:
+    """
+    List the remote directory once, then download the matching GTF files
+    concurrently
+
+    Args:
+        host: FTP server hostname
+        remote_dir: Directory on the FTP server containing the GTF files
+    Returns:
+        local_paths: Paths of the downloaded files
+    """
+
+    async with aioftp.Client.context(host) as client:
+        remote_paths = [
+            path
+            for path, info in await client.list(remote_dir)
+            if info["type"] == "file" and _is_wanted_gtf(path.name)
+        ]
+
+    semaphore = asyncio.Semaphore(max_concurrent_downloads)
+    return await asyncio.gather(
+        *(_download_one(host, path, semaphore) for path in remote_paths)
+    )
+
+
+async def _download_one(
+    host: str, remote_path: PurePosixPath, semaphore: asyncio.Semaphore
+) -> str:
+    """
+    Download a single file from the FTP server into temp_download_folder
+
+    Args:
+        host: FTP server hostname
+        remote_path: Path of the file on the FTP server
+        semaphore: Limits the number of simultaneous connections
+    Returns:
+        local_path: Path of the downloaded file
+    """
+
+    local_path = os.path.join(temp_download_folder, remote_path.name)
+    async with semaphore:
+        # FTP allows one transfer per control connection, so each
+        # download gets its own client
+        async with aioftp.Client.context(host) as client:
+            await client.download(
+                remote_path,
+                local_path,
+                write_into=True,
+                block_size=read_buffer_size,
+            )
+    print(f"Downloaded: {remote_path.name}")
+    return local_path
 
 
 def unzip_gtf_files(dir: str | os.PathLike = temp_download_folder):
@@ -68,44 +173,95 @@ def unzip_gtf_files(dir: str | os.PathLike = temp_download_folder):
         * Deletes the original .gz files
 
     """
-    for filename in os.listdir(dir):
-        if filename.endswith(".gtf.gz"):
-            gz_path = os.path.join(temp_download_folder, filename)
-            gtf_path = os.path.join(temp_download_folder, filename[:-3])
-            with gzip.open(gz_path, "rb") as f_in:
-                with open(gtf_path, "wb") as f_out:
-                    shutil.copyfileobj(f_in, f_out)
+    with os.scandir(dir) as entries:
+        paths = [
+            entry.path
+            for entry in entries
+            if entry.name.endswith(".gtf.gz") and entry.is_file()
+        ]
+    # igzip releases the GIL while inflating, so threads run in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(_unzip_one, paths))
+
+
+def _unzip_one(gz_path: str):
+    """
+    Unzip a single .gtf.gz file and delete the original zipped file
 
-            os.remove(gz_path)  # Delete the original .gz file
-            print(f"Unzipped and removed: {filename}")
+    Args:
+        gz_path: Path to the .gtf.gz file
+    Returns:
+        None
+        * Writes the .gtf file next to the .gtf.gz file
+        * Deletes the original .gz file
+    """
+
+    gtf_path = gz_path[:-3]
+    with igzip.open(gz_path, "rb") as f_in:
+        with open(gtf_path, "wb", buffering=write_buffer_size) as f_out:
+            shutil.copyfileobj(f_in, f_out, length=read_buffer_size)
 
+    os.remove(gz_path)  # Delete the original .gz file
+    print(f"Unzipped and removed: {os.path.basename(gz_path)}")
 
-def read_gtf_file(file: str | os.PathLike) -> pd.DataFrame:
+
+def read_gtf_file(
+    file: str | os.PathLike, feature: str | None = None
+) -> Iterator[pd.DataFrame]:
     """
-    Read a GTF file into a pandas dataframe
+    Read a GTF file into pandas dataframes, one chunk at a time
 
     Args:
-        file: Path to the GTF filename
+        file: Path to the GTF filename, either .gtf or .gtf.gz
+        feature: Only keep rows of this feature type (e.g. "gene")
     Returns:
-        dataframe: Pandas dataframe containing the GTF data
+        dataframes: Iterator of pandas dataframes containing the GTF data
+        * Only the gtf_used_columns are read
+        * Each chunk covers about gtf_chunk_size bytes of the file
     """
 
-    dataframe = pd.read_csv(
-        file, sep="\t", comment="#", header=None, dtype={0: str}
-    )
-    dataframe.columns = [
-        "seqname",
-        "source",
-        "feature",
-        "start",
-        "end",
-        "score",
-        "strand",
-        "frame",
-        "attribute",
-    ]
+    if os.fspath(file).endswith(".gz"):
+        source = igzip.open(file, "rb")  # ISA-L inflates faster than Arrow
+    else:
+        source = pa.memory_map(os.fspath(file), "r")  # parse from page cache
+
+    # Arrow's multi-threaded CSV reader with every column type given up front
+    with source as f_in:
+        reader = pacsv.open_csv(
+            f_in,
+            read_options=pacsv.ReadOptions(
+                column_names=gtf_columns, block_size=gtf_chunk_size
+            ),
+            parse_options=pacsv.ParseOptions(
+                delimiter="\t",
+                quote_char=False,
+                invalid_row_handler=_skip_comment_row,
+            ),
+            convert_options=pacsv.ConvertOptions(
+                column_types=gtf_column_types,
+                include_columns=gtf_used_columns,  # skip unused columns
+                null_values=[],  # GTF uses "." for missing values
+                strings_can_be_null=False,
+            ),
+        )
+        for batch in reader:
+            if feature is not None:
+                # Filter in Arrow so discarded rows never become pandas objects
+                batch = batch.filter(pc.equal(batch["feature"], feature))
+            yield batch.to_pandas(types_mapper=gtf_pandas_types.get)
+
+
+def _skip_comment_row(row: pacsv.InvalidRow) -> str:
+    """
+    Skip "#" comment lines, which Arrow sees as rows with missing columns
+
+    Args:
+        row: Row that does not have the expected number of columns
+    Returns:
+        action: "skip" for comment lines, otherwise "error"
+    """
 
-    return dataframe
+    return "skip" if row.text.startswith("#") else "error"
 
 
 def extract_key_attributes(gtf_data: pd.DataFrame) -> pd.DataFrame:
@@ -118,19 +274,109 @@ def extract_key_attributes(gtf_data: pd.DataFrame) -> pd.DataFrame:
         gene_data: Pandas dataframe containing the additional columns
     """
 
-    # Select only the rows with "gene" feature
-    gene_data = gtf_data[
-        gtf_data["feature"] == "gene"
-    ].copy()  # Create an explicit copy
+    # Select only the rows with "gene" feature; on a categorical column
+    # this compares integer codes
+    gene_data = gtf_data.iloc[gtf_data["feature"].values == "gene"]
 
-    # Regex for extracting attributes
-    gene_data.loc[:, "gene_id"] = gene_data["attribute"].str.extract(
-        r'gene_id\s*"(.+?)"'
+    # Scan the raw UTF-8 bytes of the attribute column for each key
+    attribute = pa.array(gene_data["attribute"], type=pa.string())
+    attributes = pd.DataFrame(
+        {
+            key: pd.arrays.ArrowExtensionArray(
+                _extract_attribute(attribute, key_bytes)
+            )
+            for key, key_bytes in key_attribute_bytes.items()
+        },
+        index=gene_data.index,
     )
-    gene_data.loc[:, "gene_biotype"] = gene_data["attribute"].str.extract(
-        r'gene_biotype\s*"(.+?)"'
+    # Add the new columns without copying the selected rows again
+    return pd.concat([gene_data, attributes], axis=1, copy=False)
+
+
+def _extract_attribute(
+    attribute: pa.StringArray, key_bytes: np.ndarray
+) -> pa.StringArray:
+    """
+    Extract the value of a `key "value"` pair from each GTF attribute string
+
+    Args:
+        attribute: Arrow array of GTF attribute strings
+        key_bytes: Attribute name as a uint8 array, from key_attribute_bytes
+    Returns:
+        values: Arrow array of values, null where the key is missing
+    """
+
+    if len(attribute) == 0:
+        return pa.array([], type=pa.string())
+
+    _, offsets_buffer, data_buffer = attribute.buffers()
+    offsets = np.frombuffer(offsets_buffer, dtype=np.int32)[
+        attribute.offset : attribute.offset + len(attribute) + 1
+    ]
+    data = np.frombuffer(data_buffer, dtype=np.uint8)
+
+    value_offsets, value_data, found = _scan_attribute(data, offsets, key_bytes)
+    return pa.StringArray.from_buffers(
+        len(attribute),
+        pa.py_buffer(value_offsets),
+        pa.py_buffer(value_data),
+        pa.array(found).buffers()[1],  # bit-packed bools double as validity
     )
-    return gene_data
+
+
+@numba.njit(cache=True, nogil=True)
+def _scan_attribute(data, offsets, key):
+    """
+    Find the first `key\\s*"value"` in each row of a UTF-8 string buffer
+
+    Args:
+        data: Bytes of all attribute strings, end to end
+        offsets: Start of each row in data, plus the end of the last row
+        key: Bytes of the attribute name
+    Returns:
+        value_offsets: Arrow-style offsets into value_data
+        value_data: Bytes of all found values, end to end
+        found: Whether each row contains the key
+    """
+
+    n_rows = len(offsets) - 1
+    starts = np.zeros(n_rows, dtype=np.int64)
+    ends = np.zeros(n_rows, dtype=np.int64)
+    found = np.zeros(n_rows, dtype=np.bool_)
+
+    for row in range(n_rows):
+        row_end = offsets[row + 1]
+        i = offsets[row]
+        while i + len(key) <= row_end and not found[row]:
+            matched = 0
+            while matched < len(key) and data[i + matched] == key[matched]:
+                matched += 1
+            if matched == len(key):
+                quote = i + len(key)
+                while quote < row_end and (
+                    data[quote] == 32 or 9 <= data[quote] <= 13
+                ):
+                    quote += 1  # skip whitespace, like `\s*`
+                if quote < row_end and data[quote] == 34:  # opening quote
+                    # Values are at least one byte, like `(.+?)`
+                    end = quote + 2
+                    while end < row_end and data[end] != 34:
+                        end += 1
+                    if end < row_end:
+                        starts[row] = quote + 1
+                        ends[row] = end
+                        found[row] = True
+            i += 1
+
+    value_offsets = np.zeros(n_rows + 1, dtype=np.int32)
+    value_offsets[1:] = np.cumsum(ends - starts)
+    value_data = np.empty(value_offsets[-1], dtype=np.uint8)
+    for row in range(n_rows):
+        value_data[value_offsets[row] : value_offsets[row + 1]] = data[
+            starts[row] : ends[row]
+        ]
+
+    return value_offsets, value_data, found
 
 
 def transform_data(gene_data: pd.DataFrame) -> pd.DataFrame:
@@ -143,9 +389,7 @@ def transform_data(gene_data: pd.DataFrame) -> pd.DataFrame:
         output_df: Pandas dataframe containing the required columns
     """
 
-    output_df = gene_data.loc[
-        :, ["gene_id", "feature", "gene_biotype", "seqname", "source"]
-    ]
+    output_df = gene_data.loc[:, output_columns]
     return output_df
 
 
@@ -156,27 +400,166 @@ def transformation_recursion(
     Recursively transform all GTF files in the directory-prefix
 
     Args:
-        dir: Directory containing GTF files
+        dir: Directory containing GTF files (.gtf or .gtf.gz)
         output_folder: Directory to save the transformed unzip_gtf_files
     Returns:
         None
         * Transforms and saves the GTF files in the output_folder
     """
 
-    for filename in os.listdir(dir):
-        if filename.endswith(".gtf"):
-            file_path = os.path.join(dir, filename)
-            raw_data = read_gtf_file(file_path)
+    # X.gtf and X.gtf.gz write the same output file, so keep one path per
+    # name, preferring the .gtf.gz over a stale unzipped copy
+    paths = {}
+    with os.scandir(dir) as entries:
+        for entry in entries:
+            if entry.name.endswith((".gtf", ".gtf.gz")) and entry.is_file():
+                name = _gtf_name(entry.name)
+                if entry.name.endswith(".gz") or name not in paths:
+                    paths[name] = entry.path
+    os.makedirs(ouput_file_path, exist_ok=True)
+    # Parsing (Arrow) and attribute scanning (Numba) release the GIL, so
+    # threads run in parallel without pickling dataframes between processes.
+    # Each file holds its own chunks in memory, so the pool is kept small;
+    # Arrow already spreads each file's parsing over all cores
+    with ThreadPoolExecutor(max_workers=max_transform_workers) as executor:
+        futures = [
+            executor.submit(_transform_one, path, ouput_file_path)
+            for path in paths.values()
+        ]
+        for future in as_completed(futures):
+            future.result()  # Re-raise any error from the worker
+
+
+def _gtf_name(filename: str) -> str:
+    """
+    Strip the .gtf or .gtf.gz extension from a GTF filename
+
+    Args:
+        filename: Name of the GTF file
+    Returns:
+        name: Filename without its extension
+    """
+
+    return filename.removesuffix(".gz").removesuffix(".gtf")
+
+
+def _transform_one(path: str, output_folder: str | os.PathLike):
+    """
+    Transform a single GTF file and save it as a gzipped TSV in the
+    output_folder
+
+    Args:
+        path: Path to the GTF file (.gtf or .gtf.gz)
+        output_folder: Directory to save the transformed file
+    Returns:
+        None
+        * Saves the transformed file in the output_folder
+    """
+
+    filename = _gtf_name(os.path.basename(path))
+    out_file_path = os.path.join(output_folder, filename + ".gene_info.tsv.gz")
+    # Compressing at the fastest level writes far fewer bytes to disk
+    with igzip.open(
+        out_file_path, "wb", compresslevel=output_compresslevel
+    ) as f_out:
+        f_out.write(("\t".join(output_columns) + "\n").encode())
+        # Stream chunk by chunk so only one chunk is held in memory
+        for raw_data in read_gtf_file(path, feature="gene"):
             extracted_data = extract_key_attributes(raw_data)
             transformed_data = transform_data(extracted_data)
-            out_file_path = os.path.join(
-                output_folder, filename[:-4] + ".gene_info.tsv"
-            )
-            os.makedirs(output_folder, exist_ok=True)
-            transformed_data.to_csv(
-                out_file_path, sep="\t", header=True, index=False
-            )
-            print(f"Transformed and saved: {out_file_path}")
+            f_out.write(_format_rows(transformed_data))
+    print(f"Transformed and saved: {out_file_path}")
+
+
+def _format_rows(data: pd.DataFrame) -> bytes:
+    """
+    Format a dataframe as tab-separated lines, quoting fields the same way
+    as the csv module
+
+    Args:
+        data: Pandas dataframe of string or categorical columns
+    Returns:
+        rows: UTF-8 encoded lines, without a header
+    """
+
+    if len(data) == 0:
+        return b""
+
+    # Lay every column end to end in one Arrow string array
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    cells = pa.concat_arrays(
+        [
+            chunk
+            for column in table.columns
+            for chunk in pc.cast(column, pa.string()).chunks
+        ]
+    )
+    _, offsets_buffer, data_buffer = cells.buffers()
+    offsets = np.frombuffer(offsets_buffer, dtype=np.int32)[
+        cells.offset : cells.offset + len(cells) + 1
+    ]
+    cell_data = np.frombuffer(data_buffer, dtype=np.uint8)
+    valid = cells.is_valid().to_numpy(zero_copy_only=False)
+
+    return _format_tsv(cell_data, offsets, valid, table.num_columns).tobytes()
+
+
+@numba.njit(cache=True, nogil=True)
+def _format_tsv(data, offsets, valid, n_columns):
+    """
+    Write column-major string cells out as tab-separated lines
+
+    Args:
+        data: Bytes of all cells, end to end, one column after another
+        offsets: Start of each cell in data, plus the end of the last cell
+        valid: Whether each cell is non-null; nulls are written as ""
+        n_columns: Number of columns the cells make up
+    Returns:
+        rows: Bytes of the formatted lines
+    """
+
+    n_cells = len(offsets) - 1
+    n_rows = n_cells // n_columns
+
+    # Fields holding a tab, newline or quote are quoted, with inner quotes
+    # doubled, like csv.QUOTE_MINIMAL
+    quoted = np.zeros(n_cells, dtype=np.bool_)
+    size = n_cells  # a tab or newline after every cell
+    for cell in range(n_cells):
+        if not valid[cell]:
+            continue
+        size += offsets[cell + 1] - offsets[cell]
+        for i in range(offsets[cell], offsets[cell + 1]):
+            if data[i] == 34:
+                quoted[cell] = True
+                size += 1
+            elif data[i] == 9 or data[i] == 10 or data[i] == 13:
+                quoted[cell] = True
+        if quoted[cell]:
+            size += 2
+
+    rows = np.empty(size, dtype=np.uint8)
+    position = 0
+    for row in range(n_rows):
+        for column in range(n_columns):
+            cell = column * n_rows + row
+            if valid[cell]:
+                if quoted[cell]:
+                    rows[position] = 34
+                    position += 1
+                for i in range(offsets[cell], offsets[cell + 1]):
+                    rows[position] = data[i]
+                    position += 1
+                    if quoted[cell] and data[i] == 34:
+                        rows[position] = 34
+                        position += 1
+                if quoted[cell]:
+                    rows[position] = 34
+                    position += 1
+            rows[position] = 9 if column < n_columns - 1 else 10
+            position += 1
+
+    return rows
 
 
 """Main"""
@@ -191,7 +574,6 @@ def main():
     try:
 
         download_gtf_files(args.release, args.species)
-        unzip_gtf_files()
         transformation_recursion(temp_download_folder)
         print("ETL process completed successfully")
 